@@ -8,16 +8,24 @@ and leave reviews for food items.
 """
 
 import logging
+import logging.handlers
 import asyncio
+import hashlib
 import html
 import json
 import os
+import queue
+import random
 import re
 import traceback
 import sys
 import sqlite3
-from datetime import datetime
-from typing import Dict, List, Optional, Any
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
 from urllib.parse import unquote
 
 import aiohttp
@@ -26,8 +34,8 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
-from telegram.constants import ParseMode
-from telegram.error import BadRequest
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -38,9 +46,39 @@ from telegram.ext import (
     filters
 )
 
-# Configure logging
+try:
+    import uvloop
+except ImportError:  # optional speedup; not available on Windows
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:  # optional speedup; the stdlib parser is used instead
+    orjson = None
+
+# Both accept the raw response bytes, which saves orjson a decode to str
+json_loads = orjson.loads if orjson else json.loads
+# orjson gives bytes and json a str; aiohttp sends either as the body under our own Content-Type
+json_dumps = orjson.dumps if orjson else json.dumps
+
+# Configure logging: QueueHandler.prepare() still renders the message in the calling thread
+# (the event loop), but the listener thread applies the layout and does all the writing,
+# so handlers never block the event loop on I/O
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_handlers: List[logging.Handler] = [_stream_handler]
+if os.getenv("LOG_FILE"):
+    # delay=True: the file is only opened once the listener writes the first record
+    _file_handler = logging.handlers.RotatingFileHandler(
+        os.environ["LOG_FILE"], maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8', delay=True
+    )
+    _file_handler.setFormatter(_stream_handler.formatter)
+    _log_handlers.append(_file_handler)
+log_listener = logging.handlers.QueueListener(log_queue, *_log_handlers)
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(message)s',  # the queue handler only renders the message; layout is the listener's
+    handlers=[logging.handlers.QueueHandler(log_queue)],
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
@@ -48,6 +86,73 @@ logger = logging.getLogger(__name__)
 # Conversation states
 LOGIN_USERNAME, LOGIN_PASSWORD, RESERVATION_SELECTION, REVIEW_RATING, REVIEW_COMMENT = range(5)
 
+# Identical tracebacks are reported to the developer at most once per TTL window
+ERROR_REPORT_TTL = 3600
+ERROR_CACHE_MAX_SIZE = 256
+TRACEBACK_FRAME_LIMIT = 10
+
+# Food ids change with every menu, so cached rating stats are capped; the oldest entries go first
+STATS_CACHE_MAX_SIZE = 2048
+
+# Developer error reports are queued and sent in batches by a single background task
+DEVELOPER_REPORT_QUEUE_SIZE = 500
+DEVELOPER_REPORT_BATCH_SIZE = 5
+DEVELOPER_REPORT_INTERVAL = 5
+DEVELOPER_REPORT_SEPARATOR = "\n---\n"
+# Character budgets for the sections of a report, keeping it under Telegram's 4096 limit
+REPORT_UPDATE_BUDGET = 1200
+REPORT_CHAT_DATA_BUDGET = 300
+REPORT_USER_DATA_BUDGET = 600
+REPORT_TRACEBACK_BUDGET = 1800
+
+# Transient errors that are logged but never reported to the developer
+BENIGN_ERRORS = (Forbidden, RetryAfter, TimedOut)
+
+# Retry policy for the (flaky) food reservation site
+RETRY_ATTEMPTS = 4
+RETRY_BACKOFF_BASE = 0.2
+RETRY_BACKOFF_CAP = 3.0
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+# Only these may be repeated after the server might have seen them
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD'})
+# No new attempt is started once this many seconds have passed since the first one
+RETRY_TOTAL_BUDGET = 30
+# Upper bound on a server-requested Retry-After wait, so a user is never parked for minutes.
+# Only GET/HEAD wait it out; a rate-limited POST gets its 429 back straight away.
+RETRY_AFTER_CAP = 5
+# Bytes of a failed response body that make it into the log
+RESPONSE_LOG_LIMIT = 512
+
+# Patterns for scraping the OIDC login pages, compiled once
+SIGNIN_URL_RE = re.compile(r'action="/identity/login\?signin=([^"]+)"')
+IDSRV_XSRF_RE = re.compile(r'name="idsrv\.xsrf" type="hidden" value="([^"]+)"')
+AUTH_FORM_ACTION_RE = re.compile(r'<form method="post" action="([^"]+)">')
+HIDDEN_FIELD_RE = re.compile(r'name="([^"]+)" value="([^"]+)"')
+XSRF_API_TOKEN_RE = re.compile(r'value="(.*?)" id="XSRF-TOKEN"')
+
+# Connection pool sizing for the food site session
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_CONNECTIONS_PER_HOST = 20
+# Idle sockets and DNS answers are kept long enough to survive the gaps between a user's taps
+HTTP_KEEPALIVE_TIMEOUT = 75
+HTTP_DNS_CACHE_TTL = 300
+# aiohttp's default is a 5 minute total timeout, far longer than a user will wait (holding their lock)
+HTTP_REQUEST_TIMEOUT = 20
+
+# Logged-in users idle for longer than this are dropped from memory
+SESSION_IDLE_TIMEOUT = 1800
+SESSION_GC_INTERVAL = 300
+# Hard cap between GC runs; beyond it the least recently seen session makes room for a new one
+MAX_USER_SESSIONS = 10000
+# A user's reservation list is reused for this long before the food site is asked again
+RESERVATION_CACHE_TTL = 60
+
+# The only update types the handlers use; Telegram doesn't send us the rest (edits, polls, joins...)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Path the webhook server listens on when WEBHOOK_URL is set (polling is used otherwise)
+WEBHOOK_PATH = "telegram"
+
 # Persian text constants
 PERSIAN_TEXT = {
     'welcome': '🍽️ به ربات رزرو غذا خوش آمدید!\n\nلطفاً یکی از گزینه‌های زیر را انتخاب کنید:',
@@ -68,6 +173,7 @@ PERSIAN_TEXT = {
     'help': '❓ راهنما',
     'error': '❌ خطایی رخ داد. لطفاً دوباره تلاش کنید.',
     'processing': '⏳ در حال پردازش...',
+    'please_wait': '⏳ درخواست قبلی شما هنوز در حال پردازش است. لطفاً کمی صبر کنید و دوباره تلاش کنید.',
     'food_details': '🍽️ جزئیات غذا:',
     'confirm_reservation': '✅ تأیید رزرو',
     'leave_review': '📝 ثبت نظر',
@@ -77,20 +183,66 @@ PERSIAN_TEXT = {
     'review_saved': '✅ نظر شما با موفقیت ثبت شد! از شما متشکریم.',
     'view_reviews': '👀 مشاهده نظرات',
     'no_reviews': '📝 هنوز نظری ثبت نشده است.',
-    'your_reviews_title': '📝 نظرات شما:'
+    'your_reviews_title': '📝 نظرات شما:',
+    'add_to_cart': '🛒 افزودن به سبد',
+    'submit_cart': '✅ ثبت همه',
+    'cart_result': '🧾 نتیجه ثبت سبد:',
+    'cart_item_unavailable': 'دیگر در منو نیست و از سبد حذف شد',
+    'cart_item_failed': 'ناموفق؛ در سبد ماند'
 }
 
+def escape_truncated(text: str, limit: int, keep_tail: bool = False) -> str:
+    """HTML-escape text, cutting the raw text (never an entity) so the result fits in limit."""
+    escaped = html.escape(text)
+    keep = len(text)
+    while len(escaped) > limit:
+        keep = min(keep - 1, keep * limit // len(escaped))
+        escaped = html.escape(text[len(text) - keep:] if keep_tail else text[:keep])
+    return escaped
+
+async def safe_edit_message(query, text: str, markup: InlineKeyboardMarkup) -> None:
+    """Edit a callback query's message, ignoring Telegram's "not modified" error."""
+    try:
+        await query.edit_message_text(text=text, reply_markup=markup)
+    except BadRequest as e:
+        if "Message is not modified" in str(e):
+            logger.debug("Ignored 'Message is not modified' error.")
+        else:
+            raise
+
 class ReviewDatabase:
     """Database manager for storing and retrieving reviews"""
     def __init__(self, db_path: str = "reviews.db"):
         self.db_path = db_path
+        # One long-lived connection instead of opening (and leaking) a new one per query.
+        # Handlers call into this class via asyncio.to_thread, so access is serialized by a lock.
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.row_factory = sqlite3.Row
+        # WAL with synchronous=NORMAL fsyncs only at checkpoints instead of on every commit;
+        # a crash of the bot never loses committed reviews, only a power loss can drop the last few
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        # Rating stats per food, shown on every reservation list; dropped when the food gets a review
+        self._stats_cache: Dict[str, Dict] = {}
         self.init_database()
 
-    def _get_connection(self):
-        return sqlite3.connect(self.db_path)
+    @contextmanager
+    def _transaction(self):
+        with self._lock, self._conn:
+            yield self._conn
+
+    def close(self):
+        self._conn.close()
+
+    def _cache_stats(self, food_id: str, stats: Dict) -> None:
+        # Called with the lock held; dicts keep insertion order, so the first key is the oldest
+        self._stats_cache[food_id] = stats
+        if len(self._stats_cache) > STATS_CACHE_MAX_SIZE:
+            del self._stats_cache[next(iter(self._stats_cache))]
 
     def init_database(self):
-        with self._get_connection() as conn:
+        with self._transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS reviews (
@@ -106,21 +258,21 @@ class ReviewDatabase:
     def add_review(self, user_id: int, user_first_name: str, food_id: str,
                    food_name: str, rating: int, comment: Optional[str] = None) -> bool:
         try:
-            with self._get_connection() as conn:
+            with self._transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT INTO reviews (user_id, user_first_name, food_id, food_name, rating, comment)
                     VALUES (?, ?, ?, ?, ?, ?)
                 ''', (user_id, user_first_name, food_id, food_name, rating, comment))
+                self._stats_cache.pop(food_id, None)
             return True
         except sqlite3.Error as e:
-            logger.error(f"Error adding review: {e}")
+            logger.error("Error adding review: %s", e)
             return False
 
     def get_food_reviews(self, food_id: str) -> List[Dict]:
         try:
-            with self._get_connection() as conn:
-                conn.row_factory = sqlite3.Row
+            with self._transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT user_first_name, rating, comment, created_at FROM reviews
@@ -128,13 +280,12 @@ class ReviewDatabase:
                 ''', (food_id,))
                 return [dict(row) for row in cursor.fetchall()]
         except sqlite3.Error as e:
-            logger.error(f"Error getting food reviews: {e}")
+            logger.error("Error getting food reviews: %s", e)
             return []
 
     def get_user_reviews(self, user_id: int) -> List[Dict]:
         try:
-            with self._get_connection() as conn:
-                conn.row_factory = sqlite3.Row
+            with self._transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT food_name, rating, comment, created_at FROM reviews
@@ -142,59 +293,172 @@ class ReviewDatabase:
                 ''', (user_id,))
                 return [dict(row) for row in cursor.fetchall()]
         except sqlite3.Error as e:
-            logger.error(f"Error getting user reviews: {e}")
+            logger.error("Error getting user reviews: %s", e)
             return []
 
     def get_food_stats(self, food_id: str) -> Dict:
+        cached = self._stats_cache.get(food_id)
+        if cached is not None:
+            return cached
         stats = {'average_rating': 0, 'total_reviews': 0}
         try:
-            with self._get_connection() as conn:
+            with self._transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT AVG(rating), COUNT(*) FROM reviews WHERE food_id = ?', (food_id,))
                 result = cursor.fetchone()
                 if result and result[0] is not None:
                     stats['average_rating'] = round(result[0], 1)
                     stats['total_reviews'] = result[1]
+                self._cache_stats(food_id, stats)
         except sqlite3.Error as e:
-            logger.error(f"Error getting food stats: {e}")
+            logger.error("Error getting food stats: %s", e)
         return stats
 
+    def get_foods_stats(self, food_ids: List[str]) -> Dict[str, Dict]:
+        """Stats for many foods at once; whatever isn't cached is fetched in a single query"""
+        empty = {'average_rating': 0, 'total_reviews': 0}
+        stats = {food_id: self._stats_cache.get(food_id) for food_id in food_ids}
+        missing = [food_id for food_id, cached in stats.items() if cached is None]
+        if missing:
+            try:
+                with self._transaction() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute(f'''
+                        SELECT food_id, AVG(rating), COUNT(*) FROM reviews
+                        WHERE food_id IN ({','.join('?' * len(missing))}) GROUP BY food_id
+                    ''', missing)
+                    found = {row[0]: {'average_rating': round(row[1], 1), 'total_reviews': row[2]}
+                             for row in cursor.fetchall()}
+                    for food_id in missing:
+                        stats[food_id] = found.get(food_id, empty)
+                        self._cache_stats(food_id, stats[food_id])
+            except sqlite3.Error as e:
+                logger.error("Error getting food stats: %s", e)
+        return {food_id: cached or empty for food_id, cached in stats.items()}
+
 class FoodReservationAPI:
     """
     REWRITTEN: API client for food reservation system based on HAR file analysis.
     Handles the complex OIDC authentication flow and uses correct API endpoints.
     """
-    def __init__(self):
-        self.base_url = "https://food.gums.ac.ir"
+    BASE_URL = "https://food.gums.ac.ir"
+    LOGIN_URL = BASE_URL + "/identity/login"
+    RESERVATION_URL = BASE_URL + "/api/v0/Reservation"
+    RESERVATION_LIST_URL = RESERVATION_URL + "?lastdate=&navigation=0"
+    # StateMessage of a reservation the site accepted
+    RESERVATION_SUCCESS_STATE = "با موفقیت ثبت شد"
+    # Parts of a reservation request that are the same for every item
+    RESERVATION_CONSTANTS = {
+        "LastCounts": 0, "Counts": 1, "PriceType": 2, "State": 0, "Type": 1,
+        "OP": 1, "OpCategory": 1, "Provider": 1, "Saved": 0
+    }
+    # The only menu fields make_reservation() sends back; everything else is dropped when the list is fetched
+    RESERVATION_FIELDS = frozenset({
+        'Row', 'Id', 'MealId', 'FoodId', 'FoodName', 'SelfId', 'Price', 'Yarane',
+        'MealName', 'DayName', 'SelfName', 'DayIndex', 'MealIndex'
+    })
+    HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36'
+    }
+
+    __slots__ = ('connector', 'session', 'xsrf_token')
+
+    def __init__(self, connector: Optional[aiohttp.BaseConnector] = None):
+        self.connector = connector
         self.session: Optional[aiohttp.ClientSession] = None
         self.xsrf_token: Optional[str] = None
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36'
-        }
+
+    @staticmethod
+    def create_connector() -> aiohttp.TCPConnector:
+        """Connection pool that can be shared by the sessions of many users."""
+        return aiohttp.TCPConnector(
+            limit=HTTP_MAX_CONNECTIONS, limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT, ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        )
+
+    @classmethod
+    async def warm_up(cls, connector: aiohttp.BaseConnector) -> None:
+        """Open a connection to the site ahead of the first login, leaving it in the shared pool."""
+        try:
+            async with aiohttp.ClientSession(
+                headers=cls.HEADERS, connector=connector, connector_owner=False,
+                timeout=aiohttp.ClientTimeout(total=HTTP_REQUEST_TIMEOUT)
+            ) as session:
+                async with session.head(cls.BASE_URL):
+                    pass
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Could not pre-connect to the food site: %s", e)
 
     async def _create_session(self):
         if not self.session or self.session.closed:
-            self.session = aiohttp.ClientSession(headers=self.headers, cookie_jar=aiohttp.CookieJar())
+            # Each user gets their own cookie jar; sockets come from the shared connector if given
+            self.session = aiohttp.ClientSession(
+                headers=self.HEADERS, cookie_jar=aiohttp.CookieJar(),
+                timeout=aiohttp.ClientTimeout(total=HTTP_REQUEST_TIMEOUT),
+                connector=self.connector or self.create_connector(),
+                connector_owner=self.connector is None
+            )
 
     async def close_session(self, context: Optional[ContextTypes.DEFAULT_TYPE] = None):
         if self.session and not self.session.closed:
             await self.session.close()
-            logger.info("Aiohttp session closed.")
+            logger.debug("Aiohttp session closed.")
             self.session = None
 
+    async def _request(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """
+        Send a request, retrying transient failures with jittered backoff.
+
+        GET/HEAD are retried on connection errors, timeouts, 429s and transient 5xx responses.
+        A POST (login, reservation) that timed out or got a 5xx may already have been applied,
+        so it is only retried when the connection couldn't be opened at all.
+        """
+        assert self.session is not None
+        idempotent = method in IDEMPOTENT_METHODS
+        retryable_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError) if idempotent \
+            else aiohttp.ClientConnectorError
+        deadline = time.monotonic() + RETRY_TOTAL_BUDGET
+        for attempt in range(RETRY_ATTEMPTS):
+            last_attempt = attempt == RETRY_ATTEMPTS - 1
+            error: Optional[BaseException] = None
+            response: Optional[aiohttp.ClientResponse] = None
+            retry_after = None
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except retryable_errors as e:
+                if last_attempt:
+                    raise
+                error = e
+            else:
+                if not idempotent or response.status not in RETRY_STATUSES or last_attempt:
+                    return response
+                retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                delay = min(int(retry_after), RETRY_AFTER_CAP)
+            else:
+                delay = min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            if time.monotonic() + delay > deadline:
+                # Out of time: hand back the last outcome instead of keeping the user (and their lock) waiting
+                if response is None:
+                    raise error
+                return response
+            if response is not None:
+                response.release()
+            logger.warning("%s %s failed (attempt %d/%d), retrying in %.2fs", method, url, attempt + 1, RETRY_ATTEMPTS, delay)
+            await asyncio.sleep(delay)
+
     async def login(self, username: str, password: str) -> bool:
         await self._create_session()
         assert self.session is not None
         try:
             # Step 1: Get login page to extract signin URL and initial XSRF token
-            login_page_url = f"{self.base_url}/identity/login"
-            async with self.session.get(login_page_url) as response:
+            async with await self._request('GET', self.LOGIN_URL) as response:
                 if response.status != 200:
-                    logger.error(f"Failed to get login page, status: {response.status}")
+                    logger.error("Failed to get login page, status: %s", response.status)
                     return False
                 login_page_html = await response.text()
-                signin_match = re.search(r'action="/identity/login\?signin=([^"]+)"', login_page_html)
-                idsrv_xsrf_match = re.search(r'name="idsrv\.xsrf" type="hidden" value="([^"]+)"', login_page_html)
+                signin_match = SIGNIN_URL_RE.search(login_page_html)
+                idsrv_xsrf_match = IDSRV_XSRF_RE.search(login_page_html)
 
                 if not signin_match or not idsrv_xsrf_match:
                     logger.error("Could not find signin URL or idsrv.xsrf token on login page.")
@@ -203,47 +467,47 @@ class FoodReservationAPI:
                 idsrv_xsrf_token = idsrv_xsrf_match.group(1)
             
             # Step 2: POST credentials to log in
-            login_post_url = f"{self.base_url}/identity/login?signin={signin_value}"
+            login_post_url = f"{self.LOGIN_URL}?signin={signin_value}"
             login_data = {
                 'idsrv.xsrf': idsrv_xsrf_token,
                 'username': username,
                 'password': password
             }
-            async with self.session.post(login_post_url, data=login_data, allow_redirects=False) as response:
+            async with await self._request('POST', login_post_url, data=login_data, allow_redirects=False) as response:
                 if response.status != 302:
-                    logger.error(f"Login POST failed, status: {response.status}. Incorrect credentials?")
+                    logger.error("Login POST failed, status: %s. Incorrect credentials?", response.status)
                     return False
                 redirect_location = response.headers.get('Location')
 
             # Step 3: Follow the authorization redirect
-            async with self.session.get(redirect_location, allow_redirects=False) as response:
+            async with await self._request('GET', redirect_location, allow_redirects=False) as response:
                 auth_html = await response.text()
-                form_action_match = re.search(r'<form method="post" action="([^"]+)">', auth_html)
+                form_action_match = AUTH_FORM_ACTION_RE.search(auth_html)
                 if not form_action_match:
                     logger.error("Could not find form action on auth page.")
                     return False
                 
                 final_post_url = form_action_match.group(1)
-                tokens = {m.group(1): m.group(2) for m in re.finditer(r'name="([^"]+)" value="([^"]+)"', auth_html)}
+                tokens = {m.group(1): m.group(2) for m in HIDDEN_FIELD_RE.finditer(auth_html)}
             
             # Step 4: POST the tokens to complete the login and get final auth cookies
-            async with self.session.post(final_post_url, data=tokens) as response:
+            async with await self._request('POST', final_post_url, data=tokens) as response:
                 if response.status != 200:
-                    logger.error(f"Final auth POST failed, status: {response.status}")
+                    logger.error("Final auth POST failed, status: %s", response.status)
                     return False
                 main_page_html = await response.text()
                 # Extract the X-XSRF-Token for API calls
-                xsrf_api_token_match = re.search(r'value="(.*?)" id="XSRF-TOKEN"', main_page_html)
+                xsrf_api_token_match = XSRF_API_TOKEN_RE.search(main_page_html)
                 if not xsrf_api_token_match:
                     logger.error("Could not find X-XSRF-TOKEN on main page after login.")
                     return False
                 self.xsrf_token = unquote(xsrf_api_token_match.group(1))
             
-            logger.info(f"Login successful for user: {username}")
+            logger.info("Login successful for user: %s", username)
             return True
 
         except Exception as e:
-            logger.error(f"An unexpected error occurred during login: {e}", exc_info=True)
+            logger.error("An unexpected error occurred during login: %s", e, exc_info=True)
             return False
 
     async def get_reservations(self) -> List[Dict]:
@@ -251,41 +515,44 @@ class FoodReservationAPI:
             logger.warning("Not logged in, can't get reservations.")
             return []
         
-        url = f"{self.base_url}/api/v0/Reservation?lastdate=&navigation=0"
-        headers = {**self.headers, 'X-XSRF-Token': self.xsrf_token}
+        headers = {'X-XSRF-Token': self.xsrf_token}
         try:
-            async with self.session.get(url, headers=headers) as response:
+            async with await self._request('GET', self.RESERVATION_LIST_URL, headers=headers) as response:
                 if response.status == 200:
-                    data = await response.json()
+                    data = json_loads(await response.read())
+                    fields = self.RESERVATION_FIELDS
                     all_days_data = []
                     for day_data in data:
+                        day_date = day_data['DayDate']
                         for meal in day_data.get("Meals", []):
+                            meal_name = meal['MealName']
                             for food in meal.get("FoodMenu", []):
+                                # Shared by every self-service option of this food, so build it once
+                                food_raw = {k: v for k, v in {**food, **meal}.items() if k in fields}
+                                id_prefix = f'{meal["Id"]}_{food["FoodId"]}_'
                                 for self_menu in food.get("SelfMenu", []):
                                     all_days_data.append({
-                                        'id': f'{meal["Id"]}_{food["FoodId"]}_{self_menu["SelfId"]}',
+                                        'id': f'{id_prefix}{self_menu["SelfId"]}',
                                         'name': food['FoodName'],
-                                        'date': day_data['DayDate'],
-                                        'time': meal['MealName'],
+                                        'date': day_date,
+                                        'time': meal_name,
                                         'price': self_menu.get('Price', 0),
-                                        'raw': {**food, **meal, **self_menu, 'Date': day_data['DayDate']}
+                                        'label': f"{food['FoodName']} - {day_date}",
+                                        'raw': {**food_raw, **{k: v for k, v in self_menu.items() if k in fields},
+                                                'Date': day_date}
                                     })
                     return all_days_data
                 else:
-                    logger.error(f"Failed to get reservations, status: {response.status}")
+                    logger.error("Failed to get reservations, status: %s", response.status)
                     return []
         except Exception as e:
-            logger.error(f"Error getting reservations: {e}", exc_info=True)
+            logger.error("Error getting reservations: %s", e, exc_info=True)
             return []
 
-    async def make_reservation(self, reservation_raw_data: Dict) -> bool:
-        if not self.session or not self.xsrf_token:
-            return False
-            
-        url = f"{self.base_url}/api/v0/Reservation"
-        headers = {**self.headers, 'X-XSRF-Token': self.xsrf_token, 'Content-Type': 'application/json;charset=UTF-8'}
-        
-        payload = [{
+    @staticmethod
+    def _reservation_item(reservation_raw_data: Dict) -> Dict:
+        return {
+            **FoodReservationAPI.RESERVATION_CONSTANTS,
             "Row": reservation_raw_data.get("Row", 0),
             "Id": reservation_raw_data.get("Id"),
             "Date": reservation_raw_data.get("Date"),
@@ -293,53 +560,167 @@ class FoodReservationAPI:
             "FoodId": reservation_raw_data.get("FoodId"),
             "FoodName": reservation_raw_data.get("FoodName"),
             "SelfId": reservation_raw_data.get("SelfId"),
-            "LastCounts": 0, "Counts": 1, "Price": reservation_raw_data.get("Price"),
-            "SobsidPrice": reservation_raw_data.get("Yarane", 0), "PriceType": 2,
-            "State": 0, "Type": 1, "OP": 1, "OpCategory": 1, "Provider": 1, "Saved": 0,
+            "Price": reservation_raw_data.get("Price"),
+            "SobsidPrice": reservation_raw_data.get("Yarane", 0),
             "MealName": reservation_raw_data.get("MealName"), "DayName": reservation_raw_data.get("DayName"),
             "SelfName": reservation_raw_data.get("SelfName"), "DayIndex": reservation_raw_data.get("DayIndex", 0),
             "MealIndex": reservation_raw_data.get("MealIndex", 0),
-        }]
+        }
+
+    async def make_reservation(self, reservation_raw_data: Dict) -> bool:
+        return (await self.make_reservations([reservation_raw_data]))[0]
+
+    async def make_reservations(self, reservations_raw_data: List[Dict]) -> List[bool]:
+        """Reserve several items in one POST; the site answers with one result per item, in order."""
+        if not self.session or not self.xsrf_token or not reservations_raw_data:
+            return [False] * len(reservations_raw_data)
+            
+        headers = {'X-XSRF-Token': self.xsrf_token, 'Content-Type': 'application/json;charset=UTF-8'}
+        payload = [self._reservation_item(raw) for raw in reservations_raw_data]
         
         try:
-            async with self.session.post(url, headers=headers, json=payload) as response:
+            async with await self._request('POST', self.RESERVATION_URL, headers=headers, data=json_dumps(payload)) as response:
                 if response.status == 200:
-                    result = await response.json()
-                    if result and result[0].get("StateMessage") == "با موفقیت ثبت شد":
-                        return True
-                logger.error(f"Reservation failed. Status: {response.status}, Response: {await response.text()}")
-                return False
+                    body = await response.read()
+                    result = json_loads(body) or []
+                    succeeded = [i < len(result) and result[i].get("StateMessage") == self.RESERVATION_SUCCESS_STATE
+                                 for i in range(len(payload))]
+                    if all(succeeded):
+                        return succeeded
+                else:
+                    # Error pages can be large HTML; only the start is worth logging, so don't read the rest
+                    body = await response.content.read(RESPONSE_LOG_LIMIT)
+                    succeeded = [False] * len(payload)
+                logger.error("Reservation failed. Status: %s, Response: %s",
+                             response.status, body[:RESPONSE_LOG_LIMIT].decode('utf-8', 'replace'))
+                return succeeded
         except Exception as e:
-            logger.error(f"Error making reservation: {e}", exc_info=True)
-            return False
+            logger.error("Error making reservation: %s", e, exc_info=True)
+            return [False] * len(reservations_raw_data)
+
+@dataclass(slots=True)
+class UserSession:
+    """Everything the bot keeps about one Telegram user, looked up with a single dict access"""
+    username: Optional[str] = None
+    logged_in: bool = False
+    last_seen: float = field(default_factory=time.monotonic)
+    # Serializes login/reservation per user so repeated taps don't flood the food site
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # The user's own logged-in client (own cookies/XSRF token, shared connection pool)
+    api: Optional[FoodReservationAPI] = None
+    # Last reservation list (prefetched at login) and when it was fetched
+    reservations: Optional[List[Dict]] = None
+    reservations_fetched_at: float = 0.0
+    # The fetch currently in flight, awaited by every caller instead of starting another
+    reservations_task: Optional[asyncio.Task] = None
+    # Bumped whenever the list is known to be out of date, so fetches started before that aren't cached
+    reservations_generation: int = 0
+
+    def cached_reservations(self) -> Optional[List[Dict]]:
+        if self.reservations and time.monotonic() - self.reservations_fetched_at < RESERVATION_CACHE_TTL:
+            return self.reservations
+        return None
+
+    def busy(self) -> bool:
+        """Whether a login/reservation or a reservation fetch is still running for this user"""
+        return self.lock.locked() or (self.reservations_task is not None and not self.reservations_task.done())
+
+    def invalidate_reservations(self) -> None:
+        self.reservations = self.reservations_task = None
+        self.reservations_generation += 1
 
 class EnhancedFoodReservationBot:
     """Enhanced bot class with review system"""
     def __init__(self, token: str):
         self.token = token
-        self.api_client = FoodReservationAPI()
+        self._connector: Optional[aiohttp.TCPConnector] = None
         self.review_db = ReviewDatabase()
-        self.user_sessions = {}
-
-    def get_main_keyboard(self) -> InlineKeyboardMarkup:
-        keyboard = [
+        # Kept in last-seen order (oldest first), so eviction and GC only look at the front
+        self.user_sessions: OrderedDict[int, UserSession] = OrderedDict()
+        self._closing_tasks: Set[asyncio.Task] = set()
+        self._err_cache: Dict[str, float] = {}
+        self._gc_task: Optional[asyncio.Task] = None
+        self._warm_up_task: Optional[asyncio.Task] = None
+        self.developer_chat_id = os.getenv("DEVELOPER_CHAT_ID")
+        self._report_queue: asyncio.Queue = asyncio.Queue(maxsize=DEVELOPER_REPORT_QUEUE_SIZE)
+        self._report_task: Optional[asyncio.Task] = None
+        # Callback handlers for logged-in users, looked up by callback_data (or its "<action>_" prefix)
+        self._callback_routes = {
+            'view_reservations': self._show_reservations,
+            'reserve': self._show_reservation_details,
+            'confirm': self._confirm_reservation,
+            'cart_add': self._add_to_cart,
+            'cart_submit': self._submit_cart,
+            'leave_review': self._prompt_rating,
+            'skip_review': self._skip_review,
+            'rating': self._select_rating,
+        }
+        # Static keyboards are shown after almost every action; PTB markups are immutable, so build them once
+        self._main_keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton(PERSIAN_TEXT['login'], callback_data='login')],
             [InlineKeyboardButton(PERSIAN_TEXT['view_reservations'], callback_data='view_reservations')],
             [InlineKeyboardButton(PERSIAN_TEXT['my_reviews'], callback_data='my_reviews')],
             [InlineKeyboardButton(PERSIAN_TEXT['help'], callback_data='help')]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        ])
+        self._back_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(PERSIAN_TEXT['back'], callback_data='back')]])
+        self._rating_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⭐" * i, callback_data=f'rating_{i}') for i in range(1, 4)],
+            [InlineKeyboardButton("⭐" * i, callback_data=f'rating_{i}') for i in range(4, 6)],
+            [InlineKeyboardButton(PERSIAN_TEXT['skip_review'], callback_data='skip_review')]
+        ])
+        self._review_prompt_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(PERSIAN_TEXT['leave_review'], callback_data='leave_review')],
+            [InlineKeyboardButton(PERSIAN_TEXT['skip_review'], callback_data='skip_review')]
+        ])
+
+    def get_session(self, user_id: int) -> UserSession:
+        session = self.user_sessions.get(user_id)
+        if session is None:
+            if len(self.user_sessions) >= MAX_USER_SESSIONS:
+                self._evict_oldest_session()
+            session = self.user_sessions[user_id] = UserSession()
+        else:
+            self.touch_session(user_id, session)
+        return session
+
+    def touch_session(self, user_id: int, session: UserSession) -> None:
+        session.last_seen = time.monotonic()
+        self.user_sessions.move_to_end(user_id)
+
+    def _evict_oldest_session(self) -> None:
+        # Oldest first; only busy sessions are skipped, so this normally stops at the first entry
+        for uid, session in self.user_sessions.items():
+            if not session.busy():
+                break
+        else:
+            return
+        del self.user_sessions[uid]
+        if session.api:
+            task = asyncio.get_running_loop().create_task(session.api.close_session())
+            self._closing_tasks.add(task)  # keep a reference until it's done
+            task.add_done_callback(self._closing_tasks.discard)
+
+    async def fetch_reservations(self, session: UserSession) -> List[Dict]:
+        task = session.reservations_task
+        if task is None or task.done():
+            task = session.reservations_task = asyncio.create_task(session.api.get_reservations())
+        generation = session.reservations_generation
+        # Shielded so one waiter being cancelled doesn't cancel the request for the others
+        reservations = await asyncio.shield(task)
+        # Failures come back empty and must not be cached; neither may a list that a reservation
+        # made in the meantime has already outdated (the caller still gets what it asked for)
+        if reservations and generation == session.reservations_generation:
+            session.reservations, session.reservations_fetched_at = reservations, time.monotonic()
+        return reservations
+
+    def get_main_keyboard(self) -> InlineKeyboardMarkup:
+        return self._main_keyboard
 
     def get_back_keyboard(self) -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup([[InlineKeyboardButton(PERSIAN_TEXT['back'], callback_data='back')]])
+        return self._back_keyboard
 
     def get_rating_keyboard(self) -> InlineKeyboardMarkup:
-        keyboard = [
-            [InlineKeyboardButton("⭐" * i, callback_data=f'rating_{i}') for i in range(1, 4)],
-            [InlineKeyboardButton("⭐" * i, callback_data=f'rating_{i}') for i in range(4, 6)],
-            [InlineKeyboardButton(PERSIAN_TEXT['skip_review'], callback_data='skip_review')]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return self._rating_keyboard
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(PERSIAN_TEXT['welcome'], reply_markup=self.get_main_keyboard())
@@ -354,101 +735,170 @@ class EnhancedFoodReservationBot:
         user_id = query.from_user.id
         data = query.data
 
-        async def safe_edit_message(text: str, markup: InlineKeyboardMarkup):
-            try:
-                await query.edit_message_text(text=text, reply_markup=markup)
-            except BadRequest as e:
-                if "Message is not modified" in str(e):
-                    logger.warning("Ignored 'Message is not modified' error.")
-                else:
-                    raise
-
         if data == 'login':
-            await safe_edit_message(PERSIAN_TEXT['login_prompt'], self.get_back_keyboard())
+            await safe_edit_message(query, PERSIAN_TEXT['login_prompt'], self.get_back_keyboard())
             return LOGIN_USERNAME
 
         if data == 'back':
-            await safe_edit_message(PERSIAN_TEXT['welcome'], self.get_main_keyboard())
+            await safe_edit_message(query, PERSIAN_TEXT['welcome'], self.get_main_keyboard())
             return ConversationHandler.END
 
-        if user_id not in self.user_sessions or not self.user_sessions[user_id].get('logged_in'):
-            await safe_edit_message("ابتدا باید وارد حساب کاربری خود شوید.", self.get_main_keyboard())
+        session = self.user_sessions.get(user_id)
+        if session is None or not session.logged_in:
+            await safe_edit_message(query, "ابتدا باید وارد حساب کاربری خود شوید.", self.get_main_keyboard())
             return ConversationHandler.END
+        self.touch_session(user_id, session)
 
-        if data == 'view_reservations':
-            await query.edit_message_text(PERSIAN_TEXT['processing'])
-            reservations = await self.api_client.get_reservations()
-            if not reservations:
-                await safe_edit_message(PERSIAN_TEXT['no_reservations'], self.get_main_keyboard())
-                return ConversationHandler.END
-
-            keyboard = []
-            # Limit to first 20 reservations to avoid hitting Telegram message limits
-            for i, res in enumerate(reservations[:20]):
-                stats = self.review_db.get_food_stats(res['id'])
-                rating_info = f" ⭐{stats['average_rating']}" if stats['total_reviews'] > 0 else ""
-                button_text = f"{res['name']} - {res['date']}{rating_info}"
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=f'reserve_{i}')])
-            
-            keyboard.append([InlineKeyboardButton(PERSIAN_TEXT['back'], callback_data='back')])
-            context.user_data['reservations'] = reservations
-            await safe_edit_message(PERSIAN_TEXT['select_reservation'], InlineKeyboardMarkup(keyboard))
-            return RESERVATION_SELECTION
-
-        elif data.startswith('reserve_'):
-            idx = int(data.split('_')[1])
-            res = context.user_data['reservations'][idx]
-            stats = self.review_db.get_food_stats(res['id'])
-            details = (f"{PERSIAN_TEXT['food_details']}\n\n"
-                       f"🍽️ نام: {res.get('name', 'نامشخص')}\n"
-                       f"📅 تاریخ: {res.get('date', 'نامشخص')}\n"
-                       f"⏰ زمان: {res.get('time', 'نامشخص')}\n"
-                       f"💰 قیمت: {res.get('price', 0)} ریال\n")
-            if stats['total_reviews'] > 0:
-                details += f"\n⭐ میانگین امتیاز: {stats['average_rating']}/5 ({stats['total_reviews']} نظر)\n"
-            
-            keyboard = [
-                [InlineKeyboardButton(PERSIAN_TEXT['confirm_reservation'], callback_data=f'confirm_{idx}')],
-                [InlineKeyboardButton(PERSIAN_TEXT['view_reviews'], callback_data=f'view_reviews_{idx}')],
-                [InlineKeyboardButton(PERSIAN_TEXT['back'], callback_data='view_reservations')]
-            ]
-            await safe_edit_message(details, InlineKeyboardMarkup(keyboard))
-            return RESERVATION_SELECTION
-
-        elif data.startswith('confirm_'):
-            idx = int(data.split('_')[1])
-            res = context.user_data['reservations'][idx]
+        # Exact actions first, then "<action>_<arg>" callbacks such as "reserve_3"
+        route, arg = self._callback_routes.get(data), ''
+        if route is None:
+            action, _, arg = data.rpartition('_')
+            route = self._callback_routes.get(action)
+        if route is None:
+            return ConversationHandler.END
+        return await route(query, context, session, arg)
+
+    async def _show_reservations(self, query, context: ContextTypes.DEFAULT_TYPE,
+                                 session: UserSession, arg: str) -> int:
+        reservations = session.cached_reservations()
+        if reservations is None:
             await query.edit_message_text(PERSIAN_TEXT['processing'])
-            success = await self.api_client.make_reservation(res['raw'])
-            if success:
-                context.user_data['last_reservation'] = res
-                keyboard = [
-                    [InlineKeyboardButton(PERSIAN_TEXT['leave_review'], callback_data='leave_review')],
-                    [InlineKeyboardButton(PERSIAN_TEXT['skip_review'], callback_data='skip_review')]
-                ]
-                await safe_edit_message(PERSIAN_TEXT['reservation_success'], InlineKeyboardMarkup(keyboard))
-                return REVIEW_RATING
-            else:
-                await safe_edit_message(PERSIAN_TEXT['reservation_failed'], self.get_main_keyboard())
-                return ConversationHandler.END
+            reservations = await self.fetch_reservations(session)
+        if not reservations:
+            await safe_edit_message(query, PERSIAN_TEXT['no_reservations'], self.get_main_keyboard())
+            return ConversationHandler.END
 
-        elif data == 'leave_review':
-            await safe_edit_message(PERSIAN_TEXT['rating_prompt'], self.get_rating_keyboard())
+        # Limit to first 20 reservations to avoid hitting Telegram message limits
+        shown = reservations[:20]
+        # sqlite runs in a worker thread so disk latency never stalls other users' updates
+        all_stats = await asyncio.to_thread(self.review_db.get_foods_stats, [res['id'] for res in shown])
+        keyboard = []
+        for i, res in enumerate(shown):
+            stats = all_stats[res['id']]
+            # Only the rating can change between renders; the rest of the label comes with the list
+            button_text = f"{res['label']} ⭐{stats['average_rating']}" if stats['total_reviews'] > 0 else res['label']
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=f'reserve_{i}')])
+        
+        cart = context.user_data.get('cart')
+        if cart:
+            keyboard.append([InlineKeyboardButton(f"{PERSIAN_TEXT['submit_cart']} ({len(cart)})", callback_data='cart_submit')])
+        keyboard.append([InlineKeyboardButton(PERSIAN_TEXT['back'], callback_data='back')])
+        context.user_data['reservations'] = reservations
+        await safe_edit_message(query, PERSIAN_TEXT['select_reservation'], InlineKeyboardMarkup(keyboard))
+        return RESERVATION_SELECTION
+
+    @staticmethod
+    def _selected_reservation(context: ContextTypes.DEFAULT_TYPE, idx: int) -> Optional[Dict]:
+        """The entry a reserve_/confirm_/cart_add_ button points at, if the list it was built from is still current"""
+        reservations = context.user_data.get('reservations')
+        if reservations and 0 <= idx < len(reservations):
+            return reservations[idx]
+        return None
+
+    async def _show_reservation_details(self, query, context: ContextTypes.DEFAULT_TYPE,
+                                        session: UserSession, arg: str) -> int:
+        idx = int(arg)
+        res = self._selected_reservation(context, idx)
+        if res is None:  # the list this button came from is gone, e.g. after a re-login
+            return await self._show_reservations(query, context, session, '')
+        stats = await asyncio.to_thread(self.review_db.get_food_stats, res['id'])
+        details = (f"{PERSIAN_TEXT['food_details']}\n\n"
+                   f"🍽️ نام: {res.get('name', 'نامشخص')}\n"
+                   f"📅 تاریخ: {res.get('date', 'نامشخص')}\n"
+                   f"⏰ زمان: {res.get('time', 'نامشخص')}\n"
+                   f"💰 قیمت: {res.get('price', 0)} ریال\n")
+        if stats['total_reviews'] > 0:
+            details += f"\n⭐ میانگین امتیاز: {stats['average_rating']}/5 ({stats['total_reviews']} نظر)\n"
+        
+        keyboard = [
+            [InlineKeyboardButton(PERSIAN_TEXT['confirm_reservation'], callback_data=f'confirm_{idx}')],
+            [InlineKeyboardButton(PERSIAN_TEXT['add_to_cart'], callback_data=f'cart_add_{idx}')],
+            [InlineKeyboardButton(PERSIAN_TEXT['view_reviews'], callback_data=f'view_reviews_{idx}')],
+            [InlineKeyboardButton(PERSIAN_TEXT['back'], callback_data='view_reservations')]
+        ]
+        await safe_edit_message(query, details, InlineKeyboardMarkup(keyboard))
+        return RESERVATION_SELECTION
+
+    async def _confirm_reservation(self, query, context: ContextTypes.DEFAULT_TYPE,
+                                   session: UserSession, arg: str) -> int:
+        res = self._selected_reservation(context, int(arg))
+        if res is None:  # the list this button came from is gone, e.g. after a re-login
+            return await self._show_reservations(query, context, session, '')
+        async with session.lock:
+            await query.edit_message_text(PERSIAN_TEXT['processing'])
+            success = await session.api.make_reservation(res['raw'])
+        if success:
+            session.invalidate_reservations()  # the list changed on the site
+            context.user_data['last_reservation'] = res
+            await safe_edit_message(query, PERSIAN_TEXT['reservation_success'], self._review_prompt_keyboard)
             return REVIEW_RATING
+        else:
+            await safe_edit_message(query, PERSIAN_TEXT['reservation_failed'], self.get_main_keyboard())
+            return ConversationHandler.END
+
+    async def _add_to_cart(self, query, context: ContextTypes.DEFAULT_TYPE,
+                           session: UserSession, arg: str) -> int:
+        res = self._selected_reservation(context, int(arg))
+        if res is None:  # the list this button came from is gone, e.g. after a re-login
+            return await self._show_reservations(query, context, session, '')
+        # Keyed by reservation id, so adding the same item twice doesn't reserve it twice
+        context.user_data.setdefault('cart', {})[res['id']] = res
+        return await self._show_reservations(query, context, session, '')
 
-        elif data == 'skip_review':
-            await safe_edit_message(PERSIAN_TEXT['welcome'], self.get_main_keyboard())
+    async def _submit_cart(self, query, context: ContextTypes.DEFAULT_TYPE,
+                           session: UserSession, arg: str) -> int:
+        cart = context.user_data.get('cart')
+        if not cart:
+            return await self._show_reservations(query, context, session, '')
+        await query.edit_message_text(PERSIAN_TEXT['processing'])
+        # Check the cart against the current menu: items that have gone are dropped, the rest are
+        # sent with the current menu data rather than whatever was stored when they were added
+        current = {res['id']: res for res in session.cached_reservations() or await self.fetch_reservations(session)}
+        if not current:
+            await safe_edit_message(query, PERSIAN_TEXT['reservation_failed'], self.get_main_keyboard())
             return ConversationHandler.END
+        lines = []
+        for res_id in list(cart):
+            if res_id not in current:
+                # Can't be retried, so it leaves the cart and is marked differently from a failed POST
+                lines.append(f"🚫 {cart.pop(res_id)['label']} ({PERSIAN_TEXT['cart_item_unavailable']})")
+        items = [current[res_id] for res_id in cart]
+        if items:
+            async with session.lock:
+                # One POST for the whole cart instead of one per item
+                results = await session.api.make_reservations([res['raw'] for res in items])
+            for res, success in zip(items, results):
+                if success:
+                    lines.append(f"✅ {res['label']}")
+                    del cart[res['id']]
+                else:
+                    # Failed items stay in the cart for another try
+                    lines.append(f"❌ {res['label']} ({PERSIAN_TEXT['cart_item_failed']})")
+            if any(results):
+                session.invalidate_reservations()  # the list changed on the site
+        await safe_edit_message(query, f"{PERSIAN_TEXT['cart_result']}\n\n" + "\n".join(lines), self.get_main_keyboard())
+        return ConversationHandler.END
 
-        elif data.startswith('rating_'):
-            context.user_data['review_rating'] = int(data.split('_')[1])
-            await safe_edit_message(PERSIAN_TEXT['comment_prompt'], self.get_back_keyboard())
-            return REVIEW_COMMENT
+    async def _prompt_rating(self, query, context: ContextTypes.DEFAULT_TYPE,
+                             session: UserSession, arg: str) -> int:
+        await safe_edit_message(query, PERSIAN_TEXT['rating_prompt'], self.get_rating_keyboard())
+        return REVIEW_RATING
 
+    async def _skip_review(self, query, context: ContextTypes.DEFAULT_TYPE,
+                           session: UserSession, arg: str) -> int:
+        await safe_edit_message(query, PERSIAN_TEXT['welcome'], self.get_main_keyboard())
         return ConversationHandler.END
 
+    async def _select_rating(self, query, context: ContextTypes.DEFAULT_TYPE,
+                             session: UserSession, arg: str) -> int:
+        context.user_data['review_rating'] = int(arg)
+        await safe_edit_message(query, PERSIAN_TEXT['comment_prompt'], self.get_back_keyboard())
+        return REVIEW_COMMENT
+
     async def username_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         context.user_data['username'] = update.message.text.strip()
+        # Mark the user as active now, so the cap doesn't evict them before the password arrives
+        self.get_session(update.effective_user.id)
         await update.message.reply_text(PERSIAN_TEXT['password_prompt'])
         return LOGIN_PASSWORD
 
@@ -461,11 +911,28 @@ class EnhancedFoodReservationBot:
         except Exception:
             pass
         
-        processing_msg = await update.message.reply_text(PERSIAN_TEXT['processing'])
-        success = await self.api_client.login(username, password)
+        session = self.get_session(user_id)
+        async with session.lock:
+            processing_msg = await update.message.reply_text(PERSIAN_TEXT['processing'])
+            api = FoodReservationAPI(self._connector)
+            success = await api.login(username, password)
+            if success:
+                if session.api:
+                    await session.api.close_session()
+                session.api = api
+                session.invalidate_reservations()
+                # Both were built from the previous account's menu
+                context.user_data.pop('cart', None)
+                context.user_data.pop('reservations', None)
+            else:
+                await api.close_session()
         
         if success:
-            self.user_sessions[user_id] = {'logged_in': True, 'username': username}
+            session.username = username
+            session.logged_in = True
+            # Start loading the reservation list while the user reads the success message; the handler
+            # doesn't wait for it, and "view reservations" joins the same in-flight fetch
+            context.application.create_task(self.fetch_reservations(session), update=update)
             await processing_msg.edit_text(PERSIAN_TEXT['login_success'], reply_markup=self.get_main_keyboard())
         else:
             await processing_msg.edit_text(PERSIAN_TEXT['login_failed'], reply_markup=self.get_main_keyboard())
@@ -480,7 +947,8 @@ class EnhancedFoodReservationBot:
         res = context.user_data.get('last_reservation', {})
         rating = context.user_data.get('review_rating', 5)
         
-        self.review_db.add_review(
+        await asyncio.to_thread(
+            self.review_db.add_review,
             user_id=update.effective_user.id,
             user_first_name=update.effective_user.first_name or "کاربر",
             food_id=res.get('id', ''),
@@ -491,42 +959,139 @@ class EnhancedFoodReservationBot:
         await update.message.reply_text(PERSIAN_TEXT['review_saved'], reply_markup=self.get_main_keyboard())
         return ConversationHandler.END
 
+    async def busy_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Answer updates that arrive while the user's previous one is still being handled; PTB drops them otherwise."""
+        if update.callback_query:
+            await update.callback_query.answer(PERSIAN_TEXT['please_wait'])
+        elif update.message:
+            await update.message.reply_text(PERSIAN_TEXT['please_wait'])
+
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.message.reply_text(PERSIAN_TEXT['welcome'], reply_markup=self.get_main_keyboard())
         return ConversationHandler.END
     
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Log the error and send a telegram message to notify the developer."""
+        if isinstance(context.error, BENIGN_ERRORS):
+            logger.warning("Transient Telegram error while handling an update: %s", context.error)
+            return
         logger.error("Exception while handling an update:", exc_info=context.error)
-        
-        # traceback.format_exception returns the usual python message about an exception
-        tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-        tb_string = "".join(tb_list)
+
+        # Answer the user straight away; the developer report below is only queued
+        if isinstance(update, Update) and update.effective_chat:
+            try:
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id, text=PERSIAN_TEXT['error'],
+                    reply_markup=self.get_main_keyboard()
+                )
+            except TelegramError as e:
+                logger.warning("Could not notify user about the error: %s", e)
+
+        if not self.developer_chat_id:
+            return
+
+        # Only the innermost frames are useful in the report; skip formatting (and reading
+        # source lines for) the rest of the stack
+        tb_exc = traceback.TracebackException.from_exception(context.error, limit=-TRACEBACK_FRAME_LIMIT)
+        tb_string = "".join(tb_exc.format())
+
+        # An upstream outage can raise the same error thousands of times; report it only once
+        err_hash = hashlib.blake2b(tb_string.encode(), digest_size=16).hexdigest()
+        now = time.monotonic()
+        last_reported = self._err_cache.get(err_hash)
+        if last_reported is not None and now - last_reported < ERROR_REPORT_TTL:
+            return
+        self._err_cache[err_hash] = now
+        if len(self._err_cache) > ERROR_CACHE_MAX_SIZE:
+            self._err_cache = {h: ts for h, ts in self._err_cache.items() if now - ts < ERROR_REPORT_TTL}
+            if len(self._err_cache) > ERROR_CACHE_MAX_SIZE:
+                # Still full of live entries (many distinct errors): keep only the most recent ones
+                newest = sorted(self._err_cache.items(), key=lambda item: item[1])[-ERROR_CACHE_MAX_SIZE:]
+                self._err_cache = dict(newest)
 
         # Build the message with some markup and additional information about what happened.
         update_str = update.to_dict() if isinstance(update, Update) else str(update)
         message = (
             f"An exception was raised while handling an update\n"
-            f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
+            f"<pre>update = {escape_truncated(json.dumps(update_str, indent=2, ensure_ascii=False), REPORT_UPDATE_BUDGET)}"
             "</pre>\n\n"
-            f"<pre>context.chat_data = {html.escape(str(context.chat_data))}</pre>\n\n"
-            f"<pre>context.user_data = {html.escape(str(context.user_data))}</pre>\n\n"
-            f"<pre>{html.escape(tb_string)}</pre>"
+            f"<pre>context.chat_data = {escape_truncated(str(context.chat_data), REPORT_CHAT_DATA_BUDGET)}</pre>\n\n"
+            f"<pre>context.user_data = {escape_truncated(str(context.user_data), REPORT_USER_DATA_BUDGET)}</pre>\n\n"
+            f"<pre>{escape_truncated(tb_string, REPORT_TRACEBACK_BUDGET, keep_tail=True)}</pre>"
         )
 
-        # This is a placeholder for your developer chat id
-        DEVELOPER_CHAT_ID = os.getenv("DEVELOPER_CHAT_ID")
-        if DEVELOPER_CHAT_ID:
-            # Finally, send the message
-            await context.bot.send_message(
-                chat_id=DEVELOPER_CHAT_ID, text=message, parse_mode=ParseMode.HTML
-            )
+        # Hand the report to the background reporter so the failing update isn't held up by it
+        try:
+            self._report_queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning("Developer report queue is full, dropping report.")
+
+    async def _developer_reporter(self, application: Application) -> None:
+        """Send queued error reports to the developer, packing several into one message."""
+        while True:
+            reports = [await self._report_queue.get()]
+            while len(reports) < DEVELOPER_REPORT_BATCH_SIZE and not self._report_queue.empty():
+                reports.append(self._report_queue.get_nowait())
+
+            messages: List[str] = []
+            for report in reports:
+                if messages and (len(messages[-1]) + len(DEVELOPER_REPORT_SEPARATOR) + len(report)
+                                 <= MessageLimit.MAX_TEXT_LENGTH):
+                    messages[-1] += DEVELOPER_REPORT_SEPARATOR + report
+                else:
+                    messages.append(report)
+            for message in messages:
+                try:
+                    await application.bot.send_message(
+                        chat_id=self.developer_chat_id, text=message, parse_mode=ParseMode.HTML
+                    )
+                except Exception as e:
+                    logger.error("Failed to send developer report: %s", e)
+            await asyncio.sleep(DEVELOPER_REPORT_INTERVAL)
+
+    async def _gc_sessions(self) -> None:
+        """Periodically drop sessions of users who have been idle too long."""
+        while True:
+            await asyncio.sleep(SESSION_GC_INTERVAL)
+            now = time.monotonic()
+            stale = []
+            for uid, session in self.user_sessions.items():
+                if now - session.last_seen <= SESSION_IDLE_TIMEOUT:
+                    break  # everything after this was seen more recently
+                if not session.busy():
+                    stale.append(uid)
+            for uid in stale:
+                session = self.user_sessions.pop(uid)
+                if session.api:
+                    await session.api.close_session()
+            if stale:
+                logger.info("Evicted %d idle user session(s).", len(stale))
+
+    async def post_init(self, application: Application) -> None:
+        self._connector = FoodReservationAPI.create_connector()
+        # In the background, so an unreachable food site never delays the bot coming up
+        self._warm_up_task = asyncio.create_task(FoodReservationAPI.warm_up(self._connector))
+        self._gc_task = asyncio.create_task(self._gc_sessions())
+        if self.developer_chat_id:
+            self._report_task = asyncio.create_task(self._developer_reporter(application))
+
+    async def post_shutdown(self, application: Application) -> None:
+        for task in (self._warm_up_task, self._gc_task, self._report_task):
+            if task:
+                task.cancel()
+        for session in self.user_sessions.values():
+            if session.api:
+                await session.api.close_session()
+        if self._connector:
+            await self._connector.close()
+        self.review_db.close()
 
     def create_application(self) -> Application:
         application = (
             Application.builder()
             .token(self.token)
-            .post_shutdown(self.api_client.close_session)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
             .build()
         )
         conv_handler = ConversationHandler(
@@ -537,14 +1102,21 @@ class EnhancedFoodReservationBot:
                 RESERVATION_SELECTION: [CallbackQueryHandler(self.button_handler)],
                 REVIEW_RATING: [CallbackQueryHandler(self.button_handler)],
                 REVIEW_COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.review_comment_handler)],
+                ConversationHandler.WAITING: [
+                    CallbackQueryHandler(self.busy_handler),
+                    MessageHandler(filters.ALL, self.busy_handler),
+                ],
             },
             fallbacks=[CommandHandler('cancel', self.cancel), CallbackQueryHandler(self.button_handler, pattern='^back$')],
-            allow_reentry=True
+            allow_reentry=True,
+            # Handlers wait on the food site for seconds; run them as tasks so other users aren't queued
+            # behind them. While one of a user's handlers is pending, PTB does not queue that user's
+            # further updates: they only reach the WAITING handlers, which tell the user to retry.
+            block=False
         )
-        application.add_handler(conv_handler)
-        application.add_handler(CommandHandler('help', self.help_command))
+        application.add_handlers([conv_handler, CommandHandler('help', self.help_command)])
         # Add the error handler
-        application.add_error_handler(self.error_handler)
+        application.add_error_handler(self.error_handler, block=False)
         return application
 
 def main() -> None:
@@ -553,18 +1125,45 @@ def main() -> None:
     application's built-in run_polling method, which correctly handles
     the asyncio event loop and shutdown signals.
     """
-    bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        logger.critical("FATAL: TELEGRAM_BOT_TOKEN environment variable is not set.")
-        sys.exit(1)
-
-    bot = EnhancedFoodReservationBot(bot_token)
-    application = bot.create_application()
-
-    logger.info("Starting bot...")
-    # This will run the bot until a stop signal is received (e.g., Ctrl+C or SIGTERM)
-    # It manages the entire application lifecycle gracefully.
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    log_listener.start()
+    try:
+        bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+        if not bot_token:
+            logger.critical("FATAL: TELEGRAM_BOT_TOKEN environment variable is not set.")
+            sys.exit(1)
+        webhook_url = os.getenv('WEBHOOK_URL')
+        webhook_secret = os.getenv('WEBHOOK_SECRET')
+        if webhook_url and not webhook_secret:
+            # The endpoint is public; without Telegram's secret header check anyone could post
+            # forged updates as any user and act on their logged-in food-site session
+            logger.critical("FATAL: WEBHOOK_SECRET must be set when WEBHOOK_URL is set.")
+            sys.exit(1)
+
+        if uvloop is not None:
+            # Must be installed before the application creates its event loop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+        bot = EnhancedFoodReservationBot(bot_token)
+        application = bot.create_application()
+
+        # Both run the bot until a stop signal is received (e.g., Ctrl+C or SIGTERM)
+        # and manage the entire application lifecycle gracefully.
+        if webhook_url:
+            # Telegram pushes updates to us instead of the bot long-polling getUpdates
+            logger.info("Starting bot with webhook...")
+            application.run_webhook(
+                listen='0.0.0.0',
+                port=int(os.getenv('PORT', '8443')),
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{webhook_url.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=webhook_secret,
+                allowed_updates=ALLOWED_UPDATES
+            )
+        else:
+            logger.info("Starting bot...")
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        log_listener.stop()
 
 
 if __name__ == '__main__':